@@ -49,9 +49,9 @@ qst = nkx.driver.QSR(
     optimizer=op,
     variational_state=vs,
     preconditioner=sr,
+    fused_observables={"Energy": ha},
 )
 
-obs = {"Energy": ha}
 E0 = psi.T.conj() @ (ha @ psi) / (psi.T.conj() @ psi)
 
 
@@ -61,4 +61,4 @@ def cb(step, logvals, driver):
     return True
 
 
-out = qst.run(n_iter=2000, obs=obs, callback=cb)
+out = qst.run(n_iter=2000, callback=cb)
@@ -12,47 +12,71 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import List, Optional, Tuple, Union
-from functools import partial
+from typing import Dict, List, Optional, Tuple, Union
+from functools import partial, lru_cache, reduce
+
+import hashlib
+import os
 
 import numpy as np
 import jax
 import jax.numpy as jnp
 
-from numba import njit
+from numba import njit, prange
 
 from netket import jax as nkjax
 from netket_qsr import jax as _nkjax
 from netket.driver import AbstractVariationalDriver
 from netket.driver.vmc_common import info
-from netket.operator import AbstractOperator, LocalOperator
+from netket.operator import AbstractOperator, DiscreteOperator, LocalOperator
 from netket.vqs import VariationalState
 from netket.optimizer import (
     identity_preconditioner,
     PreconditionerT,
 )
 from netket.utils import mpi
+from netket import stats as nkstats
 from netket.utils.types import PyTree
 
 BaseType = Union[AbstractOperator, np.ndarray, str]
 
+# Bump when the format returned by `_convert_data` changes, to invalidate
+# the on-disk cache.
+_CACHE_VERSION = 2
 
-def _build_rotation(hi, basis, dtype=complex):
-    localop = LocalOperator(hi, constant=1.0, dtype=dtype)
-    U_X = 1.0 / (np.sqrt(2)) * np.asarray([[1.0, 1.0], [1.0, -1.0]])
-    U_Y = 1.0 / (np.sqrt(2)) * np.asarray([[1.0, -1j], [1.0, 1j]])
+# Default number of basis states evaluated at once when computing the norm
+# of the state in `QSR.nll`.
+_NLL_CHUNK_SIZE = 4096
+
+# Largest hilbert space whose basis states are kept on device across calls
+# to `QSR.nll`.
+_NLL_MAX_CACHED_STATES = 2**20
+
+
+_U_X = 1.0 / (np.sqrt(2)) * np.asarray([[1.0, 1.0], [1.0, -1.0]])
+_U_Y = 1.0 / (np.sqrt(2)) * np.asarray([[1.0, -1j], [1.0, 1j]])
+
+
+def _basis_rotations(basis):
+    """Returns the sites on which a basis string acts, and their 2x2 rotations.
+
+    Z and I act as the identity, so the rotation to the basis only acts on
+    the X/Y sites and is the kronecker product of their single-site rotations.
+    """
+    acting_on = [j for (j, base) in enumerate(basis) if base in ("X", "Y")]
+    rotations = [_U_X if basis[j] == "X" else _U_Y for j in acting_on]
+    return acting_on, rotations
 
+
+@lru_cache(maxsize=None)
+def _build_rotation(hi, basis, dtype=complex):
     assert len(basis) == hi.size
 
-    for (j, base) in enumerate(basis):
-        if base == "X":
-            localop *= LocalOperator(hi, U_X, [j])
-        elif base == "Y":
-            localop *= LocalOperator(hi, U_Y, [j])
-        elif base == "Z" or base == "I":
-            pass
+    acting_on, rotations = _basis_rotations(basis)
+    if len(acting_on) == 0:
+        return LocalOperator(hi, constant=1.0, dtype=dtype)
 
-    return localop
+    return LocalOperator(hi, reduce(np.kron, rotations), acting_on, dtype=dtype)
 
 
 def _check_bases_type(Us: Union[List[BaseType], np.ndarray]) -> List[AbstractOperator]:
@@ -79,20 +103,94 @@ def _check_bases_type(Us: Union[List[BaseType], np.ndarray]) -> List[AbstractOpe
         hilbert = Spin(0.5, N=len(Us[0]))
         N_samples = len(Us)
 
-        _cache = {}
         _bases = np.empty(N_samples, dtype=object)
 
         for (i, basis) in enumerate(Us):
-            if basis not in _cache:
-                U = _build_rotation(hilbert, basis)
-                _cache[basis] = U
-
-            _bases[i] = _cache[basis]
+            _bases[i] = _build_rotation(hilbert, str(basis))
         return _bases
 
     raise TypeError("Unknown type of measurement basis.")
 
 
+@njit(parallel=True)
+def _apply_string_rotations(
+    sigma_s, basis_ids, n_acting, acting_sites, site_mats, local_states, secs
+):
+    N = sigma_s.shape[-1]
+    sigma_p = np.empty((secs[-1], N), dtype=sigma_s.dtype)
+    mels = np.empty((secs[-1],), dtype=site_mats.dtype)
+
+    for i in prange(sigma_s.shape[0]):
+        b = basis_ids[i]
+        k = n_acting[b]
+
+        # the c-th connected state sets the acting sites to the bits of c
+        for c in range(1 << k):
+            row = secs[i] + c
+            sigma_p[row, :] = sigma_s[i, :]
+            mel = 1.0 + 0.0j
+            for j in range(k):
+                site = acting_sites[b, j]
+                r_j = 0 if sigma_s[i, site] == local_states[0] else 1
+                c_j = (c >> (k - 1 - j)) & 1
+                sigma_p[row, site] = local_states[c_j]
+                mel *= site_mats[b, j, r_j, c_j]
+            mels[row] = mel
+
+    return sigma_p, mels
+
+
+def _convert_string_bases(sigma_s, bases):
+    """Same as :func:`_convert_data`, for bases given as strings.
+
+    Every basis is a product of single-site rotations on its X/Y sites, so
+    its connected elements are computed directly from a small table of those
+    rotations, in parallel over the samples, without building any operator.
+
+    Args:
+        sigma_s (np.ndarray): The states, of shape `(Nb, N)`
+        bases (np.ndarray or list): The list of basis strings
+    """
+    from netket.hilbert import Spin
+
+    N = sigma_s.shape[-1]
+    Nb = sigma_s.shape[0]
+    if len(bases) != Nb:
+        raise ValueError(
+            f"Got {Nb} samples but {len(bases)} measurement bases, "
+            "they should be the same number."
+        )
+
+    local_states = np.asarray(Spin(0.5, N=N).local_states, dtype=sigma_s.dtype)
+    unique_bases, basis_ids = np.unique(
+        np.asarray(bases, dtype=str), return_inverse=True
+    )
+
+    n_bases = len(unique_bases)
+    n_acting = np.zeros(n_bases, dtype=np.intp)
+    acting_sites = np.zeros((n_bases, N), dtype=np.intp)
+    site_mats = np.zeros((n_bases, N, 2, 2), dtype=complex)
+    for (b, basis) in enumerate(unique_bases):
+        assert len(basis) == N
+
+        acting_on, rotations = _basis_rotations(basis)
+        n_acting[b] = len(acting_on)
+        acting_sites[b, : len(acting_on)] = acting_on
+        for (j, rotation) in enumerate(rotations):
+            site_mats[b, j] = rotation
+
+    lens = 1 << n_acting[basis_ids]
+    secs = np.zeros(Nb + 1, dtype=np.intp)
+    np.cumsum(lens, out=secs[1:])
+    MAX_LEN = int(lens.max(initial=0))
+
+    sigma_p, mels = _apply_string_rotations(
+        sigma_s, basis_ids, n_acting, acting_sites, site_mats, local_states, secs
+    )
+
+    return sigma_p, mels, secs, MAX_LEN
+
+
 def _convert_data(sigma_s, Us):
     """Converts samples and rotation operators to a more direct computational format.
 
@@ -100,129 +198,246 @@ def _convert_data(sigma_s, Us):
         sigma_s (np.ndarray): The states
         Us (np.ndarray or list): The list of rotations
     """
+    if isinstance(Us, (list, np.ndarray)) and isinstance(Us[0], str):
+        N = sigma_s.shape[-1]
+        return _convert_string_bases(sigma_s.reshape(-1, N), Us)
+
     Us = _check_bases_type(Us)
     # TODO: add Error message when user tries to convert less or more sigmas than Us
     N = sigma_s.shape[-1]
     sigma_s = sigma_s.reshape(-1, N)
     Nb = sigma_s.shape[0]
 
-    # constant number of connected states per opoerator
-    Nc = Us[0].hilbert.local_size
-    sigma_p = np.zeros((0, N), dtype=sigma_s.dtype)
-    mels = np.zeros((0,), dtype=Us[0].dtype)
+    # group the samples by rotation, so that the connected elements of all
+    # the samples measured in the same basis are computed in a single call.
+    _, basis_ids = np.unique([id(U) for U in Us], return_inverse=True)
+
+    lens = np.zeros(Nb, dtype=np.intp)
+    groups = []
+    for k in range(basis_ids.max(initial=-1) + 1):
+        idx = np.flatnonzero(basis_ids == k)
+        sections = np.empty(idx.size, dtype=np.intp)
+        sigma_p_k, mels_k = Us[idx[0]].get_conn_flattened(sigma_s[idx], sections)
+        lens[idx] = np.diff(sections, prepend=0)
+        groups.append((idx, sections, sigma_p_k, mels_k))
+
     secs = np.zeros(Nb + 1, dtype=np.intp)
-    MAX_LEN = 0
-
-    last_i = 0
-    for (i, (sigma, U)) in enumerate(zip(sigma_s, Us)):
-        sigma_p_i, mels_i = U.get_conn(sigma)
-        Nc = mels_i.size
-        sigma_p.resize((last_i + Nc, N))
-        mels.resize((last_i + Nc,))
-        sigma_p[last_i:, :] = sigma_p_i
-        mels[last_i:] = mels_i
-        secs[i] = last_i
-        last_i = last_i + Nc
-        MAX_LEN = max(Nc, MAX_LEN)
-
-    # last
-    sigma_p.resize((last_i + MAX_LEN, N))
-    mels.resize((last_i + MAX_LEN,))
-    sigma_p[last_i + Nc :, :] = 0.0
-    mels[last_i + Nc :] = 0.0
-    secs[-1] = last_i  # + MAX_LEN
+    np.cumsum(lens, out=secs[1:])
+    MAX_LEN = int(lens.max(initial=0))
+
+    sigma_p = np.empty((secs[-1], N), dtype=sigma_s.dtype)
+    mels = np.empty((secs[-1],), dtype=Us[0].dtype)
+    for (idx, sections, sigma_p_k, mels_k) in groups:
+        # position of every connected element of the group in the output
+        group_starts = sections - lens[idx]
+        dest = np.repeat(secs[idx] - group_starts, lens[idx]) + np.arange(
+            sections[-1]
+        )
+        sigma_p[dest, :] = sigma_p_k
+        mels[dest] = mels_k
 
     return sigma_p, mels, secs, MAX_LEN
 
 
-@njit
-def _compose_sampled_data(
-    sigma_p, mels, secs, MAX_LEN, sampled_indices, min_padding_factor=128
-):
-    N_samples = sampled_indices.size
-    N = sigma_p.shape[-1]
+def _convert_data_cached(sigma_s, Us, cache_dir=None):
+    """Same as :func:`_convert_data`, but caches the result in `cache_dir`.
+
+    The cache is keyed on the content of the samples and of the bases, so it
+    is only used when the bases are given as strings. Operator bases, or
+    `cache_dir=None`, always fall back to :func:`_convert_data`.
+
+    Args:
+        sigma_s (np.ndarray): The states
+        Us (np.ndarray or list): The list of rotations
+        cache_dir (str, optional): The directory where to store the cache.
+    """
+    if cache_dir is None or not isinstance(Us[0], str):
+        return _convert_data(sigma_s, Us)
+
+    sigma_s = np.ascontiguousarray(sigma_s)
+    key = hashlib.sha256()
+    key.update(f"{_CACHE_VERSION}:{sigma_s.dtype}:{sigma_s.shape}".encode())
+    key.update(sigma_s.tobytes())
+    key.update("\0".join(map(str, Us)).encode())
+
+    cache_dir = os.path.expanduser(cache_dir)
+    path = os.path.join(cache_dir, f"{key.hexdigest()}.npz")
+
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return data["sigma_p"], data["mels"], data["secs"], int(data["max_len"])
 
-    _sigma_p = np.zeros((N_samples * MAX_LEN, N), dtype=sigma_p.dtype)
-    _mels = np.zeros((N_samples * MAX_LEN,), dtype=mels.dtype)
-    _secs = np.zeros((N_samples + 1,), dtype=secs.dtype)
-    _maxlen = 0
+    sigma_p, mels, secs, MAX_LEN = _convert_data(sigma_s, Us)
 
-    last_i = 0
-    for (n, i) in enumerate(sampled_indices):
-        start_i, end_i = secs[i], secs[i + 1]
-        len_i = end_i - start_i
+    if mpi.rank == 0:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first so that a concurrent reader never
+        # sees a partially written cache entry.
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, sigma_p=sigma_p, mels=mels, secs=secs, max_len=MAX_LEN)
+        os.replace(tmp_path, path)
 
-        # print(f"{n}, {i}, {last_i}, {start_i}, {end_i}")
-        _sigma_p[last_i : last_i + len_i, :] = sigma_p[start_i:end_i, :]
-        _mels[last_i : last_i + len_i] = mels[start_i:end_i]
+    return sigma_p, mels, secs, MAX_LEN
+
+
+def _pad_sections(sigma_p, mels, secs, MAX_LEN):
+    """Pads the connected elements of every training sample to `MAX_LEN`.
+
+    The padding elements repeat the last connected state of the sample with a
+    zero matrix element, so they do not contribute to :func:`sum_sections`.
+
+    Args:
+        sigma_p: The connected states of all training samples.
+        mels: The matrix elements of all training samples.
+        secs: The sections delimiting the elements of every training sample.
+        MAX_LEN: The maximum number of connected elements of a training sample.
+
+    Returns:
+        The connected states, of shape `(N_training, MAX_LEN, N)`, and matrix
+        elements, of shape `(N_training, MAX_LEN)`.
+    """
+    starts = secs[:-1]
+    lens = secs[1:] - starts
+    offsets = np.arange(MAX_LEN)
+
+    rows = starts[:, None] + np.minimum(offsets, lens[:, None] - 1)
+    is_valid = offsets < lens[:, None]
+
+    sigma_p_block = sigma_p[rows]
+    mels_block = np.where(is_valid, mels[rows], 0).astype(mels.dtype)
 
-        last_i = last_i + len_i
-        _secs[n + 1] = last_i
+    return sigma_p_block, mels_block
 
-        _maxlen = max(_maxlen, len_i)
 
-    padding_factor = max(
-        MAX_LEN, min_padding_factor
-    )  # minimum padding at 64 to avoid excessive recmpilation
-    padded_size = padding_factor * int(np.ceil(last_i / padding_factor))
+def _compress_states(sigma):
+    """Returns `sigma` stored as int8 if this is lossless, `sigma` otherwise."""
+    sigma_int8 = sigma.astype(np.int8)
+    if np.array_equal(sigma_int8, sigma):
+        return sigma_int8
+    return sigma
 
-    _sigma_p = _sigma_p[:padded_size, :]
-    _mels = _mels[:padded_size]
 
-    return _sigma_p, _mels, _secs, _maxlen
+@partial(jax.jit, static_argnames=("batch_size", "dtype"))
+def _sample_training_data(key, sigma_p_block, mels_block, batch_size, dtype):
+    """Samples a batch of padded training data.
 
+    Args:
+        key: The PRNG key used to sample the training data.
+        sigma_p_block: The padded connected states of all training samples.
+        mels_block: The padded matrix elements of all training samples.
+        batch_size: The number of training samples to draw.
+        dtype: The dtype of the connected states fed to the network, as
+            `sigma_p_block` might be stored in a more compact dtype.
+
+    Returns:
+        The next PRNG key, the sampled indices and the flattened connected
+        states and matrix elements of the sampled data, always of length
+        `batch_size * MAX_LEN`.
+    """
+    key, subkey = jax.random.split(key)
+    # the segment ids are assigned by position in the batch, so the indices
+    # do not need to be sorted.
+    sampled_indices = jax.random.randint(
+        subkey, (batch_size,), 0, mels_block.shape[0]
+    )
+
+    _sigma_p = sigma_p_block[sampled_indices].reshape(-1, sigma_p_block.shape[-1])
+    _sigma_p = _sigma_p.astype(dtype)
+    _mels = mels_block[sampled_indices].reshape(-1)
+
+    return key, sampled_indices, _sigma_p, _mels
 
-@partial(jax.jit, static_argnums=0)
+
+@partial(jax.jit, static_argnames="afun")
 def _avg_O(afun, pars, model_state, sigma):
     sigma = sigma.reshape((-1, sigma.shape[-1]))
-    _, vjp = nkjax.vjp(lambda W: afun({"params": W, **model_state}, sigma), pars)
+    log_psi_sigma, vjp = nkjax.vjp(
+        lambda W: afun({"params": W, **model_state}, sigma), pars
+    )
     (O_avg,) = vjp(jnp.ones(sigma.shape[0]) / sigma.shape[0])
-    return jax.tree_map(lambda x: mpi.mpi_mean_jax(x)[0], O_avg)
+    return log_psi_sigma, jax.tree_map(lambda x: mpi.mpi_mean_jax(x)[0], O_avg)
+
+
+@partial(jax.jit, static_argnames="log_psi")
+def _local_estimator(log_psi, variables, log_psi_sigma, sigma_p, mels):
+    """
+    Computes the local estimator sum_p mels[:, p] psi(sigma_p[:, p]) / psi(sigma)
+    of an operator, given the log-amplitudes of the samples sigma and the
+    padded connected elements of the operator.
+    """
+    N_samples, max_conn, N = sigma_p.shape
+    log_psi_sigma_p = log_psi(variables, sigma_p.reshape(-1, N))
+    log_psi_sigma_p = log_psi_sigma_p.reshape(N_samples, max_conn)
+    return jnp.sum(mels * jnp.exp(log_psi_sigma_p - log_psi_sigma[:, None]), axis=1)
 
 
 ####
 
 
-def sum_sections(arr, secs):
+def sum_sections(arr, segment_ids, N_rows):
     """
     Equivalent to
-    for i in range(secs.size-1):
-        out[i] = jnp.sum(arr[secs[i]:secs[i+1]])
+    for i in range(N_rows):
+        out[i] = jnp.sum(arr[segment_ids == i])
 
-    secs must be 1 longer than the number of sections desired.
-    MAX_SIZE is the max length of a section
+    segment_ids must be sorted and take values in [0, N_rows).
     """
-    offsets = secs[:-1]
-    sizes = secs[1:] - offsets
+    return jax.ops.segment_sum(
+        arr, segment_ids, num_segments=N_rows, indices_are_sorted=True
+    )
 
-    N_rows = secs.size - 1
-    # Construct the indices necessary to perform the segment_sum
-    indices = jnp.repeat(jnp.arange(N_rows), sizes, total_repeat_length=arr.size)
 
-    return jax.ops.segment_sum(
-        arr, indices, num_segments=N_rows, indices_are_sorted=True
+def log_sum_sections(log_psi_sigma_p, mel, segment_ids, N_rows):
+    """
+    Computes log(sum_sections(mel * exp(log_psi_sigma_p), segment_ids, N_rows))
+    with a per-section log-sum-exp, so that it does not overflow when the
+    log-amplitudes are large, even in single precision.
+
+    Returns:
+        The log of the sums, together with the sums and the weighted
+        amplitudes, both rescaled by the exponential of the max log-amplitude
+        of their section.
+    """
+    log_max = jax.ops.segment_max(
+        log_psi_sigma_p.real,
+        segment_ids,
+        num_segments=N_rows,
+        indices_are_sorted=True,
     )
+    # sections whose amplitudes all vanish have a -inf max
+    log_max = jnp.where(jnp.isfinite(log_max), log_max, 0)
+    log_max = jax.lax.stop_gradient(log_max)
 
+    U_sigma_sigma_p_psi_sigma_p = mel * jnp.exp(log_psi_sigma_p - log_max[segment_ids])
+    psi_rotated = sum_sections(U_sigma_sigma_p_psi_sigma_p, segment_ids, N_rows)
 
-@partial(jax.jit, static_argnums=(0,))
-def local_value_rotated_kernel(log_psi, pars, sigma_p, mel, secs):
-    log_psi_sigma_p = log_psi(pars, sigma_p)
-    U_sigma_sigma_p_psi_sigma_p = mel * jnp.exp(log_psi_sigma_p)
+    return jnp.log(psi_rotated) + log_max, psi_rotated, U_sigma_sigma_p_psi_sigma_p
 
-    return jnp.log(sum_sections(U_sigma_sigma_p_psi_sigma_p, secs))
 
+@partial(jax.jit, static_argnames=("log_psi", "N_rows"))
+def grad_local_value_rotated(
+    log_psi, pars, model_state, sigma_p, mel, segment_ids, N_rows
+):
+    def log_psi_sigma_p_fun(W):
+        log_psi_sigma_p = log_psi({"params": W, **model_state}, sigma_p)
+        return log_psi_sigma_p.astype(
+            jnp.promote_types(log_psi_sigma_p.dtype, mel.dtype)
+        )
 
-@partial(jax.jit, static_argnums=(0,))
-def grad_local_value_rotated(log_psi, pars, model_state, sigma_p, mel, secs):
-    log_val_rotated, vjp = nkjax.vjp(
-        lambda W: local_value_rotated_kernel(
-            log_psi, {"params": W, **model_state}, sigma_p, mel, secs
-        ),
-        pars,
+    # Only differentiate through log_psi, and apply the chain rule of
+    # log(sum(mel * exp(log_psi))) by hand reusing the forward quantities,
+    # so that the network is evaluated and linearized only once.
+    log_psi_sigma_p, vjp = nkjax.vjp(log_psi_sigma_p_fun, pars)
+    log_val_rotated, psi_rotated, U_sigma_sigma_p_psi_sigma_p = log_sum_sections(
+        log_psi_sigma_p, mel, segment_ids, N_rows
     )
     log_val_rotated, _ = mpi.mpi_mean_jax(log_val_rotated)
 
-    (O_avg,) = vjp(jnp.ones_like(log_val_rotated) / log_val_rotated.size)
+    # d log(psi_rotated[n]) / d log_psi_sigma_p[k] = mel[k] psi[k] / psi_rotated[n]
+    # which is not affected by the rescaling of both by the same factor.
+    d_log_val = jnp.ones_like(psi_rotated) / (N_rows * psi_rotated)
+    d_log_val = d_log_val[segment_ids]
+    (O_avg,) = vjp(d_log_val * U_sigma_sigma_p_psi_sigma_p)
 
     O_avg = jax.tree_map(lambda x: mpi.mpi_mean_jax(x)[0], O_avg)
 
@@ -238,13 +453,130 @@ def compose_grads(grad_neg, grad_pos):
     )
 
 
+@partial(jax.jit, static_argnames="real_mask")
+def _take_real(tree, real_mask):
+    """
+    Takes the real part of the leaves of `tree` flagged in `real_mask`, a
+    tuple of booleans with one entry per leaf.
+    """
+    leaves, treedef = jax.tree_util.tree_flatten(tree)
+    leaves = [x.real if take_real else x for (x, take_real) in zip(leaves, real_mask)]
+    return jax.tree_util.tree_unflatten(treedef, leaves)
+
+
+@partial(jax.jit, static_argnames=("log_psi", "batch_size", "dtype"))
+def _qsr_gradient(
+    log_psi,
+    pars,
+    model_state,
+    samples,
+    key,
+    sigma_p_block,
+    mels_block,
+    segment_ids,
+    batch_size,
+    dtype,
+):
+    """
+    Computes the gradient of the QSR loss in a single dispatch: the negative
+    phase on the samples of the variational state and the positive phase on
+    a freshly sampled batch of training data.
+
+    Returns:
+        The next PRNG key, the sampled training data (indices, connected states
+        and matrix elements), the negative and positive phase gradients, the
+        loss gradient and the log-amplitudes of the samples.
+    """
+    log_psi_sigma, grad_neg = _avg_O(log_psi, pars, model_state, samples)
+
+    key, sampled_indices, sigma_p, mels = _sample_training_data(
+        key, sigma_p_block, mels_block, batch_size, dtype
+    )
+    _, grad_pos = grad_local_value_rotated(
+        log_psi, pars, model_state, sigma_p, mels, segment_ids, batch_size
+    )
+
+    loss_grad = compose_grads(grad_neg, grad_pos)
+
+    return (
+        key,
+        sampled_indices,
+        sigma_p,
+        mels,
+        grad_neg,
+        grad_pos,
+        loss_grad,
+        log_psi_sigma,
+    )
+
+
+def _signature(args):
+    """The shapes and dtypes of the array leaves of `args`."""
+    return tuple(
+        (tuple(x.shape), jax.dtypes.canonicalize_dtype(x.dtype))
+        for x in jax.tree_util.tree_leaves(args)
+    )
+
+
 # for nll
-@partial(jax.jit, static_argnums=(0,))
-def local_value_rotated_amplitude(log_psi, pars, sigma_p, mel, secs):
+@partial(jax.jit, static_argnames=("log_psi", "N_rows"))
+def local_value_rotated_amplitude(log_psi, pars, sigma_p, mel, segment_ids, N_rows):
     log_psi_sigma_p = log_psi(pars, sigma_p)
-    U_sigma_sigma_p_psi_sigma_p = mel * jnp.exp(log_psi_sigma_p)
+    log_val_rotated, _, _ = log_sum_sections(log_psi_sigma_p, mel, segment_ids, N_rows)
+
+    # log(|psi_rotated|^2)
+    return 2 * log_val_rotated.real
+
+
+@partial(jax.jit, static_argnames=("apply_fun", "chunk_size"))
+def _log_norm(apply_fun, chunk_size, variables, hilbert_basis):
+    """
+    Computes log(sum(|psi(sigma)|^2)) over all the states in `hilbert_basis`,
+    evaluating the network on `chunk_size` states at a time and merging the
+    partial sums with the log-sum-exp trick.
+    """
+    n_states, N = hilbert_basis.shape
+    n_chunks = -(-n_states // chunk_size)
+    n_pad = n_chunks * chunk_size - n_states
+
+    states = jnp.pad(hilbert_basis, ((0, n_pad), (0, 0)))
+    states = states.reshape(n_chunks, chunk_size, N)
+    is_valid = (jnp.arange(n_chunks * chunk_size) < n_states).reshape(
+        n_chunks, chunk_size
+    )
+
+    def merge_chunk(carry, chunk):
+        current_max, current_sumexp = carry
+        sigma, valid = chunk
+
+        log_p = jnp.where(valid, 2 * apply_fun(variables, sigma).real, -jnp.inf)
+        new_max = jnp.maximum(current_max, log_p.max())
+        new_sumexp = current_sumexp * jnp.exp(current_max - new_max) + jnp.exp(
+            log_p - new_max
+        ).sum()
+        return (new_max, new_sumexp), None
 
-    return jnp.log(jnp.abs(sum_sections(U_sigma_sigma_p_psi_sigma_p, secs)) ** 2)
+    dtype = jax.eval_shape(apply_fun, variables, states[0]).dtype
+    dtype = jnp.finfo(dtype).dtype
+    init = (jnp.array(-jnp.inf, dtype=dtype), jnp.array(0, dtype=dtype))
+
+    (maxl, sumexp), _ = jax.lax.scan(merge_chunk, init, (states, is_valid))
+    return jnp.log(sumexp) + maxl
+
+
+@partial(jax.jit, static_argnames=("log_psi", "chunk_size", "N_rows"))
+def _nll(
+    log_psi, chunk_size, N_rows, variables, sigma_p, mels, segment_ids, all_states
+):
+    log_val_rot = local_value_rotated_amplitude(
+        log_psi, variables, sigma_p, mels, segment_ids, N_rows
+    )
+    ce = jnp.mean(log_val_rot)
+    # mpi
+
+    log_n = _log_norm(log_psi, chunk_size, variables, all_states)
+
+    return log_n - ce
 
 
 ####
@@ -264,6 +596,8 @@ class QSR(AbstractVariationalDriver):
         variational_state: VariationalState,
         preconditioner: PreconditionerT = identity_preconditioner,
         seed: Optional[int] = None,
+        cache_dir: Optional[str] = None,
+        fused_observables: Optional[Dict[str, DiscreteOperator]] = None,
     ):
         """Initializes the QSR driver class.
 
@@ -276,9 +610,19 @@ class QSR(AbstractVariationalDriver):
             preconditioner: The preconditioner to use.
                 Defaults to identity_preconditioner.
             seed: The RNG seed. Defaults to None.
+            cache_dir: A directory (for example `~/.cache/netket_qsr`) where
+                to cache the preprocessed training data, so that constructing
+                the driver again on the same data is fast. Only used when the
+                bases are given as strings. Defaults to None (no caching).
+            fused_observables: A dictionary of observables whose expectation
+                values are computed at every logged step on the samples already
+                used for the gradient, and logged under their key. This is
+                cheaper than passing them as `obs` to `run`, which evaluates
+                the network on the samples again. Defaults to None.
 
         Raises:
-            TypeError: If the training data is not a 2 element tuple.
+            TypeError: If the training data is not a 2 element tuple, or a
+                fused observable is not a discrete operator.
         """
 
         super().__init__(variational_state, optimizer)
@@ -292,69 +636,128 @@ class QSR(AbstractVariationalDriver):
         if not isinstance(training_data, tuple) or len(training_data) != 2:
             raise TypeError("not a tuple of length 2")
 
-        self._rng = np.random.default_rng(
-            np.asarray(nkjax.mpi_split(nkjax.PRNGKey(seed)))
-        )
+        self._rng_key = nkjax.mpi_split(nkjax.PRNGKey(seed))
 
-        sigma_p, mels, secs, MAX_LEN = _convert_data(*training_data)
+        sigma_p, mels, secs, MAX_LEN = _convert_data_cached(
+            *training_data, cache_dir=cache_dir
+        )
+        sigma_p_block, mels_block = _pad_sections(sigma_p, mels, secs, MAX_LEN)
         self._training_samples, self._training_rotations = training_data
-        self._training_sigma_p = sigma_p
-        self._training_mels = mels
         self._training_secs = secs
         self._training_max_len = MAX_LEN
         self._training_samples_n = len(secs) - 1
+        self._training_dtype = sigma_p.dtype
+        # kept on device, so that the training batches are sampled and
+        # gathered without any host to device transfer. The states are
+        # usually integers, which are stored compactly and cast back to
+        # their dtype when the batch is gathered.
+        self._training_sigma_p_block = jax.device_put(
+            _compress_states(sigma_p_block)
+        )
+        self._training_mels_block = jax.device_put(mels_block)
 
         self.training_batch_size = training_batch_size
+        # every sampled training sample spans exactly MAX_LEN elements
+        self._segment_ids = jnp.repeat(
+            jnp.arange(training_batch_size, dtype=jnp.int32), MAX_LEN
+        )
+
+        # gradient leaves of real parameters for which only the real part is kept
+        self._take_real_mask = tuple(
+            not jnp.iscomplexobj(x)
+            for x in jax.tree_util.tree_leaves(self.state.parameters)
+        )
+
+        if fused_observables is None:
+            fused_observables = {}
+        for (name, op) in fused_observables.items():
+            if not isinstance(op, DiscreteOperator):
+                raise TypeError(
+                    f"The fused observable {name} is not a DiscreteOperator."
+                )
+        self._fused_observables = dict(fused_observables)
+        self._log_psi_sigma = None
+
+        # computed lazily by nll, as it is exponentially large, and only kept
+        # on device for small enough hilbert spaces.
+        self._all_states = None
+
+        self._compiled_step = None
+        self._compiled_step_signature = None
+        self._compile_step()
+
+    def _step_args(self, samples):
+        """The non-static arguments of `_qsr_gradient` for the current step."""
+        return (
+            self.state.parameters,
+            self.state.model_state,
+            samples,
+            self._rng_key,
+            self._training_sigma_p_block,
+            self._training_mels_block,
+            self._segment_ids,
+        )
+
+    def _compile_step(self):
+        """
+        Compiles `_qsr_gradient` ahead of time for the shapes of the samples
+        that the variational state will produce, so that the first step runs
+        at steady state. If those shapes cannot be known in advance, the
+        function is instead compiled on the first step.
+        """
+        state = self.state
+        try:
+            n_samples = state.chain_length * state.sampler.n_chains_per_rank
+            samples_dtype = state.sampler.dtype
+        except AttributeError:
+            return
+
+        N = state.hilbert.size
+        samples = jax.ShapeDtypeStruct((n_samples, N), samples_dtype)
+
+        args = self._step_args(samples)
+        self._compiled_step = _qsr_gradient.lower(
+            state._apply_fun, *args, self.training_batch_size, self._training_dtype
+        ).compile()
+        self._compiled_step_signature = _signature(args)
 
     def _forward_and_backward(self):
         state = self.state
 
         state.reset()
 
-        self._grad_neg = _avg_O(
-            state._apply_fun,
-            state.parameters,
-            state.model_state,
-            state.samples,
-        )
-
-        # sample training data for pos grad
-        self._sampled_indices = np.sort(
-            self._rng.integers(
-                self._training_samples_n, size=(self.training_batch_size,)
+        samples = state.samples
+        samples = samples.reshape(-1, samples.shape[-1])
+
+        # neg and pos grad, sampling the training data for the latter
+        args = self._step_args(samples)
+        if self._compiled_step_signature == _signature(args):
+            out = self._compiled_step(*args)
+        else:
+            out = _qsr_gradient(
+                state._apply_fun,
+                *args,
+                self.training_batch_size,
+                self._training_dtype,
             )
-        )
 
-        # compose data
-        self._sigma_p, self._mels, self._secs, self._maxlen = _compose_sampled_data(
-            self._training_sigma_p,
-            self._training_mels,
-            self._training_secs,
-            self._training_max_len,
+        (
+            self._rng_key,
             self._sampled_indices,
-        )
-
-        _log_val_rot, self._grad_pos = grad_local_value_rotated(
-            state._apply_fun,
-            state.parameters,
-            state.model_state,
             self._sigma_p,
             self._mels,
-            self._secs,
-        )
-
-        self._loss_grad = compose_grads(self._grad_neg, self._grad_pos)
+            self._grad_neg,
+            self._grad_pos,
+            self._loss_grad,
+            self._log_psi_sigma,
+        ) = out
 
         # if it's the identity it does
         # self._dp = self._loss_grad
         self._dp = self.preconditioner(self.state, self._loss_grad)
 
         # If parameters are real, then take only real part of the gradient (if it's complex)
-        self._dp = jax.tree_map(
-            lambda x, target: (x if jnp.iscomplexobj(target) else x.real),
-            self._dp,
-            self.state.parameters,
-        )
+        self._dp = _take_real(self._dp, self._take_real_mask)
 
         return self._dp
 
@@ -367,29 +770,49 @@ class QSR(AbstractVariationalDriver):
             Exponentially expensive in the hilbert space size!
 
         """
-        log_val_rot = local_value_rotated_amplitude(
+        all_states = self._all_states
+        if all_states is None:
+            all_states = jax.device_put(self.state.hilbert.all_states())
+            if all_states.shape[0] <= _NLL_MAX_CACHED_STATES:
+                self._all_states = all_states
+
+        chunk_size = getattr(self.state, "chunk_size", None) or _NLL_CHUNK_SIZE
+        return _nll(
             self.state._apply_fun,
+            min(chunk_size, all_states.shape[0]),
+            self.training_batch_size,
             self.state.variables,
             self._sigma_p,
             self._mels,
-            self._secs,
+            self._segment_ids,
+            all_states,
         )
 
-        ce = jnp.mean(log_val_rot)
-        # mpi
-
-        # log norm calculation
-        log_psi = self.state.log_value(self.state.hilbert.all_states())
-        maxl = log_psi.real.max()
-        log_n = jnp.log(jnp.exp(2 * (log_psi.real - maxl)).sum()) + 2 * maxl
-
-        # result
-        return log_n - ce
-
     def _log_additional_data(self, log_dict, step):
         log_dict["loss_grad_norm"] = _nkjax.tree_norm(self._loss_grad)
         log_dict["dp_norm"] = _nkjax.tree_norm(self._dp)
 
+        if len(self._fused_observables) > 0 and self._log_psi_sigma is not None:
+            # logged before the parameters are updated, so the samples and
+            # the parameters are still those of the last gradient step, and
+            # the log-amplitudes of the samples can be reused.
+            state = self.state
+            samples = state.samples
+            sigma = np.asarray(samples.reshape(-1, samples.shape[-1]))
+            # one row per chain, as since netket 3.9 the samples are stored,
+            # and flattened, chain by chain
+            n_chains = state.sampler.n_chains_per_rank
+            for (name, op) in self._fused_observables.items():
+                sigma_p, mels = op.get_conn_padded(sigma)
+                O_loc = _local_estimator(
+                    state._apply_fun,
+                    state.variables,
+                    self._log_psi_sigma,
+                    sigma_p,
+                    mels,
+                )
+                log_dict[name] = nkstats.statistics(O_loc.reshape(n_chains, -1))
+
     def __repr__(self):
         return (
             "QSR("
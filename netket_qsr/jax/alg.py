@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from functools import reduce
+from functools import partial, reduce
 from typing import Optional, Tuple, Callable
 
 import numpy as np
@@ -22,9 +22,8 @@ from jax import numpy as jnp
 
 from netket.utils.types import PyTree, Scalar
 
-from netket.jax import tree_dot, tree_conj
 
-@jax.jit
+@partial(jax.jit, static_argnames="p")
 def tree_norm(a: PyTree, *, p: int = 2) -> Scalar:
     r"""
     compute the L-p vector norm of a PyTree, interpreted as a vector.
@@ -39,4 +38,6 @@ def tree_norm(a: PyTree, *, p: int = 2) -> Scalar:
     if p != 2:
         raise NotImplementedError("Tree_norm for p!=2 not yet implemented.")
 
-    return jnp.sqrt(tree_dot(tree_conj(a), a))
+    # vdot conjugates its first argument without materializing the conjugate
+    sq_norm = sum(jnp.vdot(x, x).real for x in jax.tree_util.tree_leaves(a))
+    return jnp.sqrt(sq_norm)
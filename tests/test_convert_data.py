@@ -0,0 +1,50 @@
+# Copyright 2021 The NetKet Authors - All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+from netket_qsr.driver.qsr import _check_bases_type, _convert_data
+
+
+def _sorted_section(sigma_p, mels):
+    # order the connected elements of a section by their state
+    order = np.lexsort(sigma_p.T[::-1])
+    return sigma_p[order], mels[order]
+
+
+def test_string_bases_match_local_operators():
+    N = 4
+    n_samples = 50
+    rng = np.random.default_rng(1234)
+
+    samples = rng.choice([-1.0, 1.0], size=(n_samples, N))
+    bases = ["".join(b) for b in rng.choice(list("XYZI"), size=(n_samples, N))]
+
+    # numba kernel on the basis strings
+    sigma_p, mels, secs, MAX_LEN = _convert_data(samples, bases)
+    # LocalOperator.get_conn_flattened on the corresponding rotations
+    sigma_p_op, mels_op, secs_op, MAX_LEN_op = _convert_data(
+        samples, _check_bases_type(bases)
+    )
+
+    np.testing.assert_array_equal(secs, secs_op)
+    assert MAX_LEN == MAX_LEN_op
+
+    for i in range(n_samples):
+        section = slice(secs[i], secs[i + 1])
+        x, m = _sorted_section(sigma_p[section], mels[section])
+        x_op, m_op = _sorted_section(sigma_p_op[section], mels_op[section])
+
+        np.testing.assert_array_equal(x, x_op)
+        np.testing.assert_allclose(m, m_op, rtol=1e-12, atol=1e-12)
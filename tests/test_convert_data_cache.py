@@ -0,0 +1,62 @@
+# Copyright 2021 The NetKet Authors - All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+from netket_qsr.driver import qsr
+from netket_qsr.driver.qsr import _convert_data, _convert_data_cached
+
+
+def _assert_same_data(data, expected):
+    sigma_p, mels, secs, MAX_LEN = data
+    sigma_p_ex, mels_ex, secs_ex, MAX_LEN_ex = expected
+
+    np.testing.assert_array_equal(sigma_p, sigma_p_ex)
+    np.testing.assert_array_equal(mels, mels_ex)
+    np.testing.assert_array_equal(secs, secs_ex)
+    assert MAX_LEN == MAX_LEN_ex
+    assert sigma_p.dtype == sigma_p_ex.dtype
+    assert mels.dtype == mels_ex.dtype
+
+
+def test_convert_data_cache(tmp_path, monkeypatch):
+    N = 4
+    n_samples = 20
+    rng = np.random.default_rng(1234)
+
+    samples = rng.choice([-1.0, 1.0], size=(n_samples, N))
+    bases = ["".join(b) for b in rng.choice(list("XYZ"), size=(n_samples, N))]
+    expected = _convert_data(samples, bases)
+
+    # a miss converts the data and writes it to the cache
+    _assert_same_data(_convert_data_cached(samples, bases, tmp_path), expected)
+    cached_files = list(tmp_path.glob("*.npz"))
+    assert len(cached_files) == 1
+
+    # a hit reads the data back without converting it again
+    def _fail(*args):
+        raise AssertionError("the cached data was converted again")
+
+    with monkeypatch.context() as m:
+        m.setattr(qsr, "_convert_data", _fail)
+        _assert_same_data(_convert_data_cached(samples, bases, tmp_path), expected)
+
+    # changing a single basis misses the cache
+    new_bases = list(bases)
+    new_bases[3] = "ZZZZ" if bases[3] != "ZZZZ" else "XXXX"
+    _assert_same_data(
+        _convert_data_cached(samples, new_bases, tmp_path),
+        _convert_data(samples, new_bases),
+    )
+    assert len(list(tmp_path.glob("*.npz"))) == 2
@@ -0,0 +1,66 @@
+# Copyright 2021 The NetKet Authors - All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+
+import netket as nk
+import netket_qsr as nkx
+
+
+def test_fused_observables_match_expect():
+    N = 3
+    g = nk.graph.Chain(length=N, pbc=False)
+    hi = nk.hilbert.Spin(0.5, N=N)
+
+    ha = nk.operator.Ising(hilbert=hi, graph=g, h=1.0)
+    sx = nk.operator.spin.sigmax(hi, 0)
+    for i in range(1, N):
+        sx = sx + nk.operator.spin.sigmax(hi, i)
+    observables = {"Energy": ha, "sx": sx}
+
+    rng = np.random.default_rng(1234)
+    training_samples = rng.choice([-1.0, 1.0], size=(64, N))
+    training_bases = ["".join(b) for b in rng.choice(list("XYZ"), size=(64, N))]
+
+    vs = nk.vqs.MCState(
+        nk.sampler.MetropolisLocal(hi, n_chains=16),
+        nk.models.RBM(alpha=1, param_dtype=complex),
+        n_samples=1008,
+        n_discard_per_chain=10,
+        seed=0,
+        sampler_seed=1,
+    )
+    driver = nkx.driver.QSR(
+        (training_samples, training_bases),
+        32,
+        nk.optimizer.Sgd(learning_rate=0.01),
+        variational_state=vs,
+        fused_observables=observables,
+    )
+
+    # samples the state, without updating the parameters
+    driver._forward_and_backward()
+    log_dict = {}
+    driver._log_additional_data(log_dict, driver.step_count)
+
+    for (name, op) in observables.items():
+        fused = log_dict[name]
+        # uses the samples cached by the driver step
+        expected = vs.expect(op)
+
+        np.testing.assert_allclose(fused.mean, expected.mean, rtol=1e-8)
+        np.testing.assert_allclose(
+            fused.error_of_mean, expected.error_of_mean, rtol=1e-8
+        )
+        np.testing.assert_allclose(fused.R_hat, expected.R_hat, rtol=1e-8)
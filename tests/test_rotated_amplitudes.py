@@ -0,0 +1,165 @@
+# Copyright 2021 The NetKet Authors - All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+import netket as nk
+from netket import jax as nkjax
+
+from netket_qsr.driver.qsr import (
+    _convert_data,
+    _pad_sections,
+    grad_local_value_rotated,
+    local_value_rotated_amplitude,
+    log_sum_sections,
+    sum_sections,
+)
+
+
+def _training_data(N, n_samples, seed=1234):
+    rng = np.random.default_rng(seed)
+    samples = rng.choice([-1.0, 1.0], size=(n_samples, N))
+    bases = ["".join(b) for b in rng.choice(list("XYZ"), size=(n_samples, N))]
+
+    # padded as in the driver, so that some matrix elements are zero
+    sigma_p, mels, secs, MAX_LEN = _convert_data(samples, bases)
+    sigma_p_block, mels_block = _pad_sections(sigma_p, mels, secs, MAX_LEN)
+    segment_ids = np.repeat(np.arange(n_samples), MAX_LEN)
+
+    return (
+        jnp.asarray(sigma_p_block.reshape(-1, N)),
+        jnp.asarray(mels_block.reshape(-1)),
+        jnp.asarray(segment_ids),
+    )
+
+
+@pytest.mark.parametrize(
+    "model",
+    [
+        pytest.param(nk.models.RBM(alpha=1, param_dtype=complex), id="RBM"),
+        pytest.param(
+            nk.models.RBMModPhase(alpha=1, param_dtype=float), id="RBMModPhase"
+        ),
+    ],
+)
+def test_grad_local_value_rotated(model):
+    N = 4
+    n_samples = 16
+    sigma_p, mels, segment_ids = _training_data(N, n_samples)
+
+    variables = model.init(jax.random.PRNGKey(0), sigma_p[:1])
+    pars, model_state = variables["params"], {}
+    log_psi = model.apply
+
+    log_val, grad = grad_local_value_rotated(
+        log_psi, pars, model_state, sigma_p, mels, segment_ids, n_samples
+    )
+
+    # autodiff of the naive expression
+    def naive_log_val(W):
+        log_psi_sigma_p = log_psi({"params": W}, sigma_p)
+        return jnp.log(
+            sum_sections(mels * jnp.exp(log_psi_sigma_p), segment_ids, n_samples)
+        )
+
+    log_val_ex, vjp = nkjax.vjp(naive_log_val, pars)
+    (grad_ex,) = vjp(jnp.ones_like(log_val_ex) / n_samples)
+
+    np.testing.assert_allclose(log_val, log_val_ex, rtol=1e-10, atol=1e-12)
+    jax.tree_util.tree_map(
+        lambda x, y: np.testing.assert_allclose(x, y, rtol=1e-8, atol=1e-12),
+        grad,
+        grad_ex,
+    )
+
+
+def _large_log_psi(pars, sigma):
+    # log-amplitudes around 100, whose exponential overflows in single precision
+    return pars["offset"] + sigma @ pars["w"] + 1j * (sigma @ pars["phi"])
+
+
+def test_log_sum_sections_single_precision():
+    N = 4
+    n_samples = 16
+    sigma_p, mels, segment_ids = _training_data(N, n_samples)
+
+    rng = np.random.default_rng(0)
+    pars = {
+        "offset": np.float32(100.0),
+        "w": rng.normal(size=N).astype(np.float32),
+        "phi": rng.normal(size=N).astype(np.float32),
+    }
+    sigma_p = sigma_p.astype(np.float32)
+    mels = mels.astype(np.complex64)
+
+    def naive_log_val(pars, sigma_p, mels):
+        log_psi_sigma_p = _large_log_psi(pars, sigma_p)
+        return jnp.log(
+            sum_sections(mels * jnp.exp(log_psi_sigma_p), segment_ids, n_samples)
+        )
+
+    # the naive expression overflows in single precision
+    assert not np.all(np.isfinite(naive_log_val(pars, sigma_p, mels)))
+
+    # but not in double precision, which is used as reference
+    pars_64 = jax.tree_util.tree_map(lambda x: x.astype(np.float64), pars)
+    sigma_p_64 = sigma_p.astype(np.float64)
+    mels_64 = mels.astype(np.complex128)
+    log_val_64 = naive_log_val(pars_64, sigma_p_64, mels_64)
+    assert np.all(np.isfinite(log_val_64))
+
+    log_val, _, _ = log_sum_sections(
+        _large_log_psi(pars, sigma_p), mels, segment_ids, n_samples
+    )
+    assert log_val.dtype == np.complex64
+    np.testing.assert_allclose(log_val.real, log_val_64.real, rtol=1e-5)
+    # the imaginary part is only defined modulo 2 pi
+    np.testing.assert_allclose(
+        np.exp(1j * log_val.imag), np.exp(1j * log_val_64.imag), atol=1e-4
+    )
+
+    def mean_log_amp(pars, sigma_p, mels):
+        return local_value_rotated_amplitude(
+            _large_log_psi, pars, sigma_p, mels, segment_ids, n_samples
+        ).mean()
+
+    log_amp, grad = jax.value_and_grad(mean_log_amp)(pars, sigma_p, mels)
+    log_amp_64, grad_64 = jax.value_and_grad(
+        lambda pars: 2 * naive_log_val(pars, sigma_p_64, mels_64).real.mean()
+    )(pars_64)
+
+    assert log_amp.dtype == np.float32
+    np.testing.assert_allclose(log_amp, log_amp_64, rtol=1e-5)
+    jax.tree_util.tree_map(
+        lambda x, y: np.testing.assert_allclose(x, y, rtol=1e-4, atol=1e-4),
+        grad,
+        grad_64,
+    )
+
+
+def test_log_sum_sections_vanishing_section():
+    log_psi_sigma_p = jnp.array([0.5, -jnp.inf, -jnp.inf, 1.0], dtype=jnp.float32)
+    mels = jnp.ones(4, dtype=jnp.float32)
+    segment_ids = jnp.array([0, 1, 1, 2])
+
+    log_val, psi_rotated, _ = log_sum_sections(log_psi_sigma_p, mels, segment_ids, 3)
+
+    # the section whose amplitudes all vanish has a zero sum, rather than nan
+    np.testing.assert_array_equal(psi_rotated[1], 0.0)
+    assert log_val[1] == -np.inf
+    np.testing.assert_allclose(np.asarray(log_val)[[0, 2]], [0.5, 1.0], rtol=1e-6)